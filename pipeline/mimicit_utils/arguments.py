@@ -306,17 +306,33 @@ def add_data_args(parser=None):
     group.add_argument("--seq2seq", action="store_true", help="to use seq2seq dataset")
     group.add_argument("--outputs", type=str, default="")
     group.add_argument("--patch-image-size", type=int, default=224)
+    group.add_argument(
+        "--patch-pool-size",
+        type=int,
+        default=0,
+        help="number of transformed image patches cached per data worker, 0 disables the cache. "
+        "Each fp32 patch takes patch_image_size**2 * 12 bytes (~600 KB at 224, half that for a bf16/fp16 vision encoder), "
+        "per worker, dataset and rank, "
+        "and the cache only lives as long as the worker, i.e. one epoch unless workers are persistent",
+    )
+    group.add_argument(
+        "--parsed-cache-dir",
+        type=str,
+        default=None,
+        help="directory to cache the parsed dataset and train_config json files in as pickles, unset disables the cache. "
+        "The caches are unpickled on startup, so only use a directory that nobody else can write to",
+    )
     group.add_argument("--imagenet-default-mean-and-std", type=bool, default=False)
     group.add_argument(
         "--max-src-length",
         type=int,
-        default=128,
+        default=256,
         help="the maximum src sequence length",
     )
     group.add_argument(
         "--max-tgt-length",
         type=int,
-        default=30,
+        default=256,
         help="the maximum target sequence length",
     )
     group.add_argument("--prompt-type", type=str, default=None, help="prompt_type")
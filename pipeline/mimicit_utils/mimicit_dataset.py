@@ -3,12 +3,22 @@
 # This source code is licensed under the Apache 2.0 license
 # found in the LICENSE file in the root directory.
 
-import base64
 from io import BytesIO
 import re
 import contextlib
+import hashlib
+import logging
+import math
+from array import array
+import mmap
 import os
-import orjson
+import pickle
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+import ijson
+import pybase64
 
 from PIL import ImageFile
 from torchvision import transforms
@@ -18,7 +28,7 @@ import sys
 
 from .transforms import *
 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, get_worker_info
 
 
 IMAGENET_DEFAULT_MEAN = (0.485, 0.456, 0.406)
@@ -31,6 +41,118 @@ ImageFile.LOAD_TRUNCATED_IMAGES = True
 ImageFile.MAX_IMAGE_PIXELS = None
 Image.MAX_IMAGE_PIXELS = None
 
+# text normalization shared by pre_question / pre_answer / pre_caption
+_MULTI_WHITESPACE_RE = re.compile(r"\s{2,}")
+_LEADING_PUNCTUATION = ",.!?*#:;~"
+_SEPARATOR_TO_SPACE = str.maketrans({"-": " ", "/": " "})
+
+# how each task (keyed by train id prefix) assembles a sample in MimicitDataset._process:
+# shuffle - shuffle the in-context examples together with the query
+# use_in_context - prepend the in-context examples at all
+# image_per_chunk - every example brings its own first image and <image> token, otherwise the
+#                   sample's images are fed together behind a single leading <image> token
+_DENSE_CAPTION_CONFIG = dict(shuffle=True, use_in_context=True, image_per_chunk=False)
+_TASK_CONFIGS = {
+    "LA": dict(shuffle=False, use_in_context=True, image_per_chunk=True),
+    "DC": _DENSE_CAPTION_CONFIG,
+    "E4D": _DENSE_CAPTION_CONFIG,
+    "SD": dict(shuffle=False, use_in_context=False, image_per_chunk=False),
+    "SN": dict(shuffle=False, use_in_context=True, image_per_chunk=False),
+    "FunQA": _DENSE_CAPTION_CONFIG,
+}
+
+# threads decoding the images of a single sample, see MimicitDataset._load_patches
+_DECODE_POOL_WORKERS = 4
+_decode_pool = None
+_decode_pool_pid = None
+
+
+def _get_decode_pool():
+    global _decode_pool, _decode_pool_pid
+    # threads do not survive a fork, so every DataLoader worker creates its own pool
+    if _decode_pool is None or _decode_pool_pid != os.getpid():
+        _decode_pool = ThreadPoolExecutor(max_workers=_DECODE_POOL_WORKERS)
+        _decode_pool_pid = os.getpid()
+    return _decode_pool
+
+
+def _load_packed_json(path, prefix=""):
+    with open(path, "rb") as f:
+        return _PackedDict(ijson.kvitems(f, prefix, use_float=True))
+
+
+def _iter_json_images(path):
+    with open(path, "rb") as f:
+        for k, v in ijson.kvitems(f, ""):
+            yield k, v.encode("ascii")
+
+
+def _load_cached(path, load_fn, cache_dir=None):
+    """Return load_fn(path), cached as a pickle in cache_dir and reused as long as the file's size and mtime are unchanged."""
+    if cache_dir is None:
+        return load_fn(path)
+
+    # caches are only read from the configured cache_dir
+    path_hash = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, f"{os.path.basename(path)}.{path_hash}.pkl")
+    stat = os.stat(path)
+    cache_key = (stat.st_size, stat.st_mtime_ns)
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as f:
+                if pickle.load(f) == cache_key:
+                    return pickle.load(f)
+        except Exception as e:
+            logging.warning(f"Discarding the unreadable cache {cache_path} ({repr(e)}).")
+            with contextlib.suppress(OSError):
+                os.remove(cache_path)
+
+    data = load_fn(path)
+    # write to a temporary file first, so that concurrently starting ranks never read a partial cache
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            pickle.dump(cache_key, f, protocol=5)
+            pickle.dump(data, f, protocol=5)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.warning(f"Could not write the cache {cache_path} ({repr(e)}).")
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+    return data
+
+
+class _PackedDict:
+    """Read-only dict whose values are packed into a single bytearray, pickled unless serialize=False."""
+
+    def __init__(self, items, serialize=True):
+        self._serialize = serialize
+        self._positions = {}
+        self._buffer = bytearray()
+        self._offsets = array("q", [0])
+        for position, (key, value) in enumerate(items):
+            self._positions[key] = position
+            self._buffer += pickle.dumps(value, protocol=5) if serialize else value
+            self._offsets.append(len(self._buffer))
+
+    def __getitem__(self, key):
+        position = self._positions[key]
+        payload = memoryview(self._buffer)[self._offsets[position] : self._offsets[position + 1]]
+        return pickle.loads(payload) if self._serialize else payload
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def keys(self):
+        return self._positions.keys()
+
 
 @contextlib.contextmanager
 def random_seed(seed, *addl_seeds):
@@ -80,15 +202,24 @@ class MimicitDataset(Dataset):
 
         scales = [(args.patch_image_size, args.patch_image_size)]
 
-        self.patch_resize_transform = transforms.Compose(
-            [
-                RandomResize(scales),
-                transforms.CenterCrop(args.patch_image_size),
-                transforms.RandomHorizontalFlip(p=0.5),
-                transforms.ToTensor(),
-                transforms.Normalize(mean=FLAMINGO_MEAN, std=FLAMINGO_STD),
-            ]
-        )
+        # the resize scale is drawn in _load_patches, on the calling thread, and applied in _decode_patch
+        self.patch_resize_sizes = scales
+        patch_transforms = [
+            transforms.CenterCrop(args.patch_image_size),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=FLAMINGO_MEAN, std=FLAMINGO_STD),
+        ]
+        # emit bf16/fp16 patches for a bf16/fp16 vision encoder
+        vision_dtype = getattr(args, "vision_dtype", None)
+        if vision_dtype in (torch.bfloat16, torch.float16):
+            patch_transforms.append(transforms.ConvertImageDtype(vision_dtype))
+        self.patch_resize_transform = transforms.Compose(patch_transforms)
+        # the flip is applied after the patch pool so that cached patches still get augmented
+        self.patch_flip_transform = transforms.RandomHorizontalFlip(p=0.5)
+
+        # LRU pool of transformed patches, keyed by image id
+        self._tensor_pool = OrderedDict()
+        self._pool_cap = args.patch_pool_size
 
         self.multi_instruct_path = cur_multi_instruct_path
         self.images_path = cur_images_path
@@ -100,68 +231,72 @@ class MimicitDataset(Dataset):
 
         assert os.path.exists(cur_train_config_path), f"Error: The local train_config_path {cur_train_config_path} not exists!"
 
-        # Load the dataset
-        with open(self.multi_instruct_path, "rb") as f:
-            self.dataset = orjson.loads(f.read())["data"]
-
-        # Load the images
-        with open(self.images_path, "rb") as f:
-            self.images = orjson.loads(f.read())
+        # Load the dataset, stream-parsed into a _PackedDict and cached in --parsed-cache-dir if set
+        self.parsed_cache_dir = args.parsed_cache_dir
+        self.dataset = _load_cached(self.multi_instruct_path, partial(_load_packed_json, prefix="data"), self.parsed_cache_dir)
+
+        # Load the images, an .idx file (see pipeline/utils/convert_images_to_mmap.py) points into a .bin file of
+        # decoded image bytes that is memory-mapped lazily, so forked workers share the page cache instead of copying the images
+        self._image_mmap = None
+        if self.images_path.endswith(".idx"):
+            self.images = None
+            with open(self.images_path, "rb") as f:
+                self._image_index = pickle.load(f)
+            self._image_payload_path = f"{self.images_path[:-len('.idx')]}.bin"
+            assert os.path.exists(self._image_payload_path), f"Error: The local image payload {self._image_payload_path} not exists!"
+        else:
+            # base64 payloads kept as bytes, not cached
+            self.images = _PackedDict(_iter_json_images(self.images_path), serialize=False)
 
         # Load the train_config
-        with open(self.train_config_path, "rb") as f:
-            self.train_config = orjson.loads(f.read())
+        self.train_config = _load_cached(self.train_config_path, _load_packed_json, self.parsed_cache_dir)
 
         self.train_data_list = list(self.train_config.keys())
 
-        self.bos_item = torch.LongTensor([args.tokenizer.bos_token_id])
-        self.eos_item = torch.LongTensor([args.tokenizer.eos_token_id])
-        self.bos_mask = torch.LongTensor([1])
-        self.eos_mask = torch.LongTensor([1])
+        # task handler of every sample, raises on train ids of unsupported tasks
+        self._task_handlers = {task_prefix: partial(self._process, **task_config) for task_prefix, task_config in _TASK_CONFIGS.items()}
+        self._handlers = [self._prefix_to_handler(cur_train_id) for cur_train_id in self.train_data_list]
 
     def pre_question(self, question, max_ques_words):
-        question = question.lower().lstrip(",.!?*#:;~").replace("-", " ").replace("/", " ")
+        question = question.lower().lstrip(_LEADING_PUNCTUATION).translate(_SEPARATOR_TO_SPACE)
 
-        question = re.sub(
-            r"\s{2,}",
-            " ",
-            question,
-        )
+        question = _MULTI_WHITESPACE_RE.sub(" ", question)
         question = question.rstrip("\n")
         question = question.strip(" ")
 
         # truncate question
-        question_words = question.split(" ")
+        question_words = question.split(" ", max_ques_words)
         if len(question_words) > max_ques_words:
             question = " ".join(question_words[:max_ques_words])
 
         return question
 
     def pre_answer(self, answer, max_ans_words):
-        answer = re.sub(
-            r"\s{2,}",
-            " ",
-            answer,
-        )
+        answer = _MULTI_WHITESPACE_RE.sub(" ", answer)
         answer = answer.rstrip("\n")
         answer = answer.strip(" ")
 
         # truncate question
         return_answer = ""
+        return_answer_spaces = 0
         answers = answer.split(".")
 
         for _ in answers:
+            # count words through spaces
             if return_answer == "":
                 cur_answer = _
+                cur_answer_spaces = _.count(" ")
             else:
                 cur_answer = ".".join([return_answer, _])
-            if len(cur_answer.split(" ")) <= max_ans_words:
+                cur_answer_spaces = return_answer_spaces + _.count(" ")
+            if cur_answer_spaces < max_ans_words:
                 return_answer = cur_answer
+                return_answer_spaces = cur_answer_spaces
             else:
                 break
 
         if return_answer == "":
-            answer_words = answer.split(" ")
+            answer_words = answer.split(" ", max_ans_words)
             return_answer = " ".join(answer_words[:max_ans_words])
         else:
             if return_answer[-1] != "." and return_answer != answers:
@@ -170,18 +305,14 @@ class MimicitDataset(Dataset):
         return return_answer
 
     def pre_caption(self, caption, max_words):
-        caption = caption.lower().lstrip(",.!?*#:;~").replace("-", " ").replace("/", " ").replace("<person>", "person")
+        caption = caption.lower().lstrip(_LEADING_PUNCTUATION).translate(_SEPARATOR_TO_SPACE).replace("<person>", "person")
 
-        caption = re.sub(
-            r"\s{2,}",
-            " ",
-            caption,
-        )
+        caption = _MULTI_WHITESPACE_RE.sub(" ", caption)
         caption = caption.rstrip("\n")
         caption = caption.strip(" ")
 
         # truncate caption
-        caption_words = caption.split(" ")
+        caption_words = caption.split(" ", max_words)
         if len(caption_words) > max_words:
             caption = " ".join(caption_words[:max_words])
 
@@ -190,218 +321,93 @@ class MimicitDataset(Dataset):
     def set_epoch(self, epoch, **unused):
         self.epoch = epoch
 
-    def process_llava(self, instruction_id, instruction, answer, image_ids, in_context_example_ids):
-        patch_images = torch.tensor([])
-        all_texts = ""
-        all_instruction_ids = in_context_example_ids + [instruction_id]
-        # random.shuffle(all_instruction_ids)
-        for cur_instruction_id in all_instruction_ids[:]:
-            cur_instruction_image_id = self.dataset[cur_instruction_id]["image_ids"][0]
-            cur_instruction = self.dataset[cur_instruction_id]["instruction"]
-            cur_answer = self.dataset[cur_instruction_id]["answer"]
-            cur_image = self.images[cur_instruction_image_id]
-            cur_image = Image.open(BytesIO(base64.urlsafe_b64decode(cur_image))).convert("RGB")
-            cur_patch_image = self.patch_resize_transform(cur_image).unsqueeze(0).unsqueeze(0)
-            if len(patch_images) == 0:
-                patch_images = cur_patch_image
-            else:
-                patch_images = torch.cat((patch_images, cur_patch_image))
-
-            cur_instruction = self.pre_question(cur_instruction, self.max_src_length)
-            cur_answer = self.pre_answer(cur_answer, self.max_tgt_length)
-            cur_text = f"<image>User: {cur_instruction} GPT:<answer> {cur_answer}<|endofchunk|>"
-            all_texts += cur_text
-        # <image>User: {cur_incontext_instruction} GPT:<answer> {cur_incontext_answer}<|endofchunk|><image>User: {instruction} GPT:<answer> {answer}<|endofchunk|>
-        # incontext_text = "<image>User: What does this image descibe? GPT:<answer>The children in the image, along with the rest of the family. They are Skiing. <|endofchunk|>"
-        # query_text = f"<image>User: What does this image descibe? GPT:<answer>"
-        # query_text = f"<image>User: {instruction} GPT:<answer>"
-        # print(instruction_id, query_text, answer)
-        return patch_images, all_texts  # incontext_text, query_text
-
-    def process_dense_caption(self, instruction_id, instruction, answer, image_ids, in_context_example_ids):
-        patch_images = torch.tensor([])
-        all_texts = ""
-        all_instruction_ids = in_context_example_ids + [instruction_id]
-        random.shuffle(all_instruction_ids)
-        for cur_instruction_id in all_instruction_ids[:]:
-            cur_instruction = self.dataset[cur_instruction_id]["instruction"]
-            cur_instruction = self.pre_question(cur_instruction, self.max_src_length)
-            cur_answer = self.dataset[cur_instruction_id]["answer"]
-            cur_answer = self.pre_answer(cur_answer, self.max_tgt_length)
-            cur_text = f"User: {cur_instruction} GPT:<answer> {cur_answer}<|endofchunk|>"
-            all_texts += cur_text
-
-        all_texts = f"<image>{all_texts}"
-        # <image>User: {cur_incontext_instruction} GPT:<answer> {cur_incontext_answer}<|endofchunk|>User: {instruction} GPT:<answer> {answer}<|endofchunk|>
-        # <image>User: what does the image describe? GPT: XXX <|endofchunk|>User: Do you think this image is funny GPT:<answer> YYY <|endofchunk|>
-        for cur_image_id in image_ids:
-            cur_image = self.images[cur_image_id]
-            cur_image = Image.open(BytesIO(base64.urlsafe_b64decode(cur_image))).convert("RGB")
-            cur_patch_image = self.patch_resize_transform(cur_image).unsqueeze(0)
-            if len(patch_images) == 0:
-                patch_images = cur_patch_image
-            else:
-                patch_images = torch.cat((patch_images, cur_patch_image))
-
-        patch_images = patch_images.unsqueeze(0)
-        return patch_images, all_texts
-
-    def process_e4d(self, instruction_id, instruction, answer, image_ids, in_context_example_ids):
-        patch_images = torch.tensor([])
-        all_texts = ""
-        all_instruction_ids = in_context_example_ids + [instruction_id]
-        random.shuffle(all_instruction_ids)
-        for cur_instruction_id in all_instruction_ids[:]:
-            cur_instruction = self.dataset[cur_instruction_id]["instruction"]
-            cur_instruction = self.pre_question(cur_instruction, self.max_src_length)
-            cur_answer = self.dataset[cur_instruction_id]["answer"]
-            cur_answer = self.pre_answer(cur_answer, self.max_tgt_length)
-            cur_text = f"User: {cur_instruction} GPT:<answer> {cur_answer}<|endofchunk|>"
-            all_texts += cur_text
-
-        all_texts = f"<image>{all_texts}"
-        # <image>User: {cur_incontext_instruction} GPT:<answer> {cur_incontext_answer}<|endofchunk|>User: {instruction} GPT:<answer> {answer}<|endofchunk|>
-        # <image>User: what does the image describe? GPT: XXX <|endofchunk|>User: Do you think this image is funny GPT:<answer> YYY <|endofchunk|>
-        for cur_image_id in image_ids:
-            cur_image = self.images[cur_image_id]
-            cur_image = Image.open(BytesIO(base64.urlsafe_b64decode(cur_image))).convert("RGB")
-            cur_patch_image = self.patch_resize_transform(cur_image).unsqueeze(0)
-            if len(patch_images) == 0:
-                patch_images = cur_patch_image
-            else:
-                patch_images = torch.cat((patch_images, cur_patch_image))
-
-        patch_images = patch_images.unsqueeze(0)
-        return patch_images, all_texts
-
-    def process_spot_the_difference(self, instruction_id, instruction, answer, image_ids, in_context_example_ids):
-        patch_images = torch.tensor([])
-        incontext_text = ""
-        # <image>User: {instruction} GPT:<answer> {answer}<|endofchunk|>
-        for cur_image_id in image_ids:
-            cur_image = self.images[cur_image_id]
-            cur_image = Image.open(BytesIO(base64.urlsafe_b64decode(cur_image))).convert("RGB")
-            cur_patch_image = self.patch_resize_transform(cur_image).unsqueeze(0)
-            if len(patch_images) == 0:
-                patch_images = cur_patch_image
-            else:
-                patch_images = torch.cat((patch_images, cur_patch_image))
-
-        patch_images = patch_images.unsqueeze(0)
-        instruction = self.pre_question(instruction, self.max_src_length)
-        answer = self.pre_answer(answer, self.max_tgt_length)
-        query_text = f"<image>User: {instruction} GPT:<answer> {answer}<|endofchunk|>"
-        all_texts = f"{incontext_text}{query_text}"
-        return patch_images, all_texts
-
-    def process_scene_navigation(self, instruction_id, instruction, answer, image_ids, in_context_example_ids):
-        patch_images = torch.tensor([])
-        incontext_text = ""
-        for cur_incontext_id in in_context_example_ids:
-            cur_incontext_instruction = self.dataset[cur_incontext_id]["instruction"]
-            cur_incontext_instruction = self.pre_question(cur_incontext_instruction, self.max_src_length)
-            cur_incontext_answer = self.dataset[cur_incontext_id]["answer"]
-            cur_incontext_answer = self.pre_answer(cur_incontext_answer, self.max_tgt_length)
-            cur_incontext_text = f"User: {cur_incontext_instruction} GPT:<answer> {cur_incontext_answer}<|endofchunk|>"
-            incontext_text += cur_incontext_text
-
-        incontext_text = f"<image>{incontext_text}"
-        # <image>User: {cur_incontext_instruction} GPT:<answer> {cur_incontext_answer}<|endofchunk|>User: {instruction} GPT:<answer> {answer}<|endofchunk|>
-        for cur_image_id in image_ids:
-            cur_image = self.images[cur_image_id]
-            cur_image = Image.open(BytesIO(base64.urlsafe_b64decode(cur_image))).convert("RGB")
-            cur_patch_image = self.patch_resize_transform(cur_image).unsqueeze(0)
-            if len(patch_images) == 0:
-                patch_images = cur_patch_image
-            else:
-                patch_images = torch.cat((patch_images, cur_patch_image))
-
-        patch_images = patch_images.unsqueeze(0)
-        instruction = self.pre_question(instruction, self.max_src_length)
-        answer = self.pre_answer(answer, self.max_tgt_length)
-        query_text = f"User: {instruction} GPT:<answer> {answer}<|endofchunk|>"
-        all_texts = f"{incontext_text}{all_texts}"
-        return patch_images, all_texts
-
-    def process_funqa(self, instruction_id, instruction, answer, image_ids, in_context_example_ids):
-        patch_images = torch.tensor([])
-        all_texts = ""
-        all_instruction_ids = in_context_example_ids + [instruction_id]
-        random.shuffle(all_instruction_ids)
-        for cur_instruction_id in all_instruction_ids[:]:
-            cur_instruction = self.dataset[cur_instruction_id]["instruction"]
-            cur_instruction = self.pre_question(cur_instruction, self.max_src_length)
-            cur_answer = self.dataset[cur_instruction_id]["answer"]
-            cur_answer = self.pre_answer(cur_answer, self.max_tgt_length)
+    def _read_image(self, image_id):
+        """Returns the encoded (PNG/JPEG) bytes of an image."""
+        if self.images is not None:
+            return pybase64.urlsafe_b64decode(self.images[image_id])
+        if self._image_mmap is None:
+            with open(self._image_payload_path, "rb") as f:
+                self._image_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset, length = self._image_index[image_id]
+        return self._image_mmap[offset : offset + length]
+
+    def _decode_patch(self, encoded_image, size):
+        cur_image = resize(Image.open(BytesIO(encoded_image)).convert("RGB"), None, size)
+        return self.patch_resize_transform(cur_image)
+
+    def _load_patches(self, image_ids):
+        patches = {}
+        for image_id in image_ids:
+            if image_id in self._tensor_pool:
+                self._tensor_pool.move_to_end(image_id)
+                patches[image_id] = self._tensor_pool[image_id]
+
+        missing_ids = [image_id for image_id in dict.fromkeys(image_ids) if image_id not in patches]
+        encoded_images = [self._read_image(image_id) for image_id in missing_ids]
+        sizes = [random.choice(self.patch_resize_sizes) for _ in missing_ids]
+        # PIL decoding and the torchvision transforms release the GIL, so the images of a sample decode concurrently
+        decode_map = _get_decode_pool().map if len(encoded_images) > 1 else map
+        for image_id, patch_image in zip(missing_ids, decode_map(self._decode_patch, encoded_images, sizes)):
+            patches[image_id] = patch_image
+            if self._pool_cap > 0:
+                self._tensor_pool[image_id] = patch_image
+                if len(self._tensor_pool) > self._pool_cap:
+                    self._tensor_pool.popitem(last=False)
+
+        # the pooled tensors are shared, callers only read from them (torch.stack copies)
+        return [self.patch_flip_transform(patches[image_id]) for image_id in image_ids]
+
+    def _prefix_to_handler(self, train_id):
+        for task_prefix, handler in self._task_handlers.items():
+            if train_id.startswith(task_prefix):
+                return handler
+        raise KeyError(f"Error: The train id {train_id} does not start with any supported task prefix {list(self._task_handlers)}!")
+
+    def _process(self, instruction_id, in_context_example_ids, *, shuffle, use_in_context, image_per_chunk):
+        all_instruction_ids = in_context_example_ids + [instruction_id] if use_in_context else [instruction_id]
+        if shuffle:
+            random.shuffle(all_instruction_ids)
+
+        # prompt chunks, joined at the end
+        text_parts = [] if image_per_chunk else ["<image>"]
+        # fetch every record once
+        query_record = self.dataset[instruction_id]
+        cur_records = [query_record if cur_instruction_id == instruction_id else self.dataset[cur_instruction_id] for cur_instruction_id in all_instruction_ids]
+        for cur_record in cur_records:
+            cur_instruction = self.pre_question(cur_record["instruction"], self.max_src_length)
+            cur_answer = self.pre_answer(cur_record["answer"], self.max_tgt_length)
             cur_text = f"User: {cur_instruction} GPT:<answer> {cur_answer}<|endofchunk|>"
-            all_texts += cur_text
-
-        all_texts = f"<image>{all_texts}"
-        # <image>User: {cur_incontext_instruction} GPT:<answer> {cur_incontext_answer}<|endofchunk|>User: {instruction} GPT:<answer> {answer}<|endofchunk|>
-        # <image>User: what does the image describe? GPT: XXX <|endofchunk|>User: Do you think this image is funny GPT:<answer> YYY <|endofchunk|>
-        for cur_image_id in image_ids:
-            cur_image = self.images[cur_image_id]
-            cur_image = Image.open(BytesIO(base64.urlsafe_b64decode(cur_image))).convert("RGB")
-            cur_patch_image = self.patch_resize_transform(cur_image).unsqueeze(0)
-            if len(patch_images) == 0:
-                patch_images = cur_patch_image
-            else:
-                patch_images = torch.cat((patch_images, cur_patch_image))
+            if image_per_chunk:
+                cur_text = f"<image>{cur_text}"
+            text_parts.append(cur_text)
+        all_texts = "".join(text_parts)
+
+        if image_per_chunk:
+            # <image>User: {cur_incontext_instruction} GPT:<answer> {cur_incontext_answer}<|endofchunk|><image>User: {instruction} GPT:<answer> {answer}<|endofchunk|>
+            # one image per chunk, patch_images is (N, 1, C, H, W)
+            patch_image_ids = [cur_record["image_ids"][0] for cur_record in cur_records]
+            media_dim = 1
+        else:
+            # <image>User: {cur_incontext_instruction} GPT:<answer> {cur_incontext_answer}<|endofchunk|>User: {instruction} GPT:<answer> {answer}<|endofchunk|>
+            # all images behind the leading <image>, patch_images is (1, N, C, H, W)
+            patch_image_ids = query_record["image_ids"]
+            media_dim = 0
 
-        patch_images = patch_images.unsqueeze(0)
+        # stack the patches and add the media dimension as a view
+        patch_images = torch.stack(self._load_patches(patch_image_ids), dim=0).unsqueeze(media_dim)
         return patch_images, all_texts
 
     def process_image_text_pair(self, index):
         cur_train_id = self.train_data_list[index]
-        (
-            instruction_id,
-            instruction,
-            answer,
-            image_ids,
-            in_context_example_ids,
-        ) = (
-            cur_train_id,
-            self.dataset[cur_train_id]["instruction"],
-            self.dataset[cur_train_id]["answer"],
-            self.dataset[cur_train_id]["image_ids"],
-            self.train_config[cur_train_id],
-        )
-
-        self.max_src_length = self.max_tgt_length = 256
-
-        if cur_train_id.startswith("LA"):
-            patch_images, all_texts = self.process_llava(instruction_id, instruction, answer, image_ids, in_context_example_ids)
-        elif cur_train_id.startswith("DC"):
-            patch_images, all_texts = self.process_dense_caption(instruction_id, instruction, answer, image_ids, in_context_example_ids)
-        elif cur_train_id.startswith("E4D"):
-            patch_images, all_texts = self.process_e4d(instruction_id, instruction, answer, image_ids, in_context_example_ids)
-        elif cur_train_id.startswith("SD"):
-            patch_images, all_texts = self.process_spot_the_difference(instruction_id, instruction, answer, image_ids, in_context_example_ids)
-        elif cur_train_id.startswith("SN"):
-            patch_images, all_texts = self.process_scene_navigation(instruction_id, instruction, answer, image_ids, in_context_example_ids)
-        elif cur_train_id.startswith("FunQA"):
-            patch_images, all_texts = self.process_funqa(instruction_id, instruction, answer, image_ids, in_context_example_ids)
+        instruction_id, in_context_example_ids = cur_train_id, self.train_config[cur_train_id]
+        patch_images, all_texts = self._handlers[index](instruction_id, in_context_example_ids)
 
         # print(instruction_id, incontext_text, query_text)
 
-        src_text = self.tokenizer(
-            f"{all_texts}",
-            return_tensors="pt",
-            add_special_tokens=False,
-        )
-
-        src_item = src_text["input_ids"].squeeze(0)
-        src_item_mask = src_text["attention_mask"].squeeze(0)
-
-        src_item = torch.cat([self.bos_item, src_item, self.eos_item])
-        src_item_mask = torch.cat([self.bos_mask, src_item_mask, self.eos_mask])
-        # src_item = torch.cat([self.bos_item, src_item])
-        # src_item_mask = torch.cat([self.bos_mask, src_item_mask])
-
+        # the text is tokenized per batch in collate
         example = {
             "id": instruction_id,
-            "source": src_item,
-            "text_mask": src_item_mask,
+            "text": all_texts,
             "patch_images": patch_images,
         }
 
@@ -415,11 +421,7 @@ class MimicitDataset(Dataset):
 
     def __getitem__(self, index):
         with random_seed(self.seed, self.epoch):
-            pair_sample = self.process_image_text_pair(index)
-            # if dataset is not supported
-            if pair_sample is None:
-                return self.__getitem__(index + 1)
-        return pair_sample
+            return self.process_image_text_pair(index)
 
     def collate(self, samples):
         """Merge samples of different tasks to form two mini-batches.
@@ -433,32 +435,36 @@ class MimicitDataset(Dataset):
         for sample_tuple in samples:
             samples_v1.append(sample_tuple)
 
+        if len(samples_v1) > 0:
+            src_texts = self.tokenizer([sample["text"] for sample in samples_v1], add_special_tokens=False)
+            for sample, src_ids in zip(samples_v1, src_texts["input_ids"]):
+                sample["source"] = src_ids
+
         res_v1 = collate_fn(
             samples_v1,
             pad_idx=self.tokenizer.pad_token_id,
+            bos_idx=self.tokenizer.bos_token_id,
             eos_idx=self.tokenizer.eos_token_id,
         )
         return res_v1
 
 
-def collate_fn(samples, pad_idx, eos_idx):
+def collate_fn(samples, pad_idx, bos_idx, eos_idx):
     if len(samples) == 0:
         return {}
 
-    def merge(key, pad_idx, pading_size=None):
-        res = collate_tokens(
-            [s[key] for s in samples],
-            pad_idx,
-            eos_idx=eos_idx,
-            pad_to_length=pading_size,
-        )
-        return res
+    # right-padded [bos] + tokens + [eos] batch
+    lengths = torch.tensor([len(s["source"]) for s in samples]).unsqueeze(1)
+    larger_size = int(lengths.max()) + 2
+    positions = torch.arange(larger_size).unsqueeze(0)
 
-    larger_size = max([s["source"].size(0) for s in samples])
+    src_tokens = _new_batch_tensor(lengths, len(samples), larger_size).fill_(pad_idx)
+    src_tokens[:, 0] = bos_idx
+    src_tokens[(positions > 0) & (positions <= lengths)] = torch.tensor(list(chain.from_iterable(s["source"] for s in samples)), dtype=torch.long)
+    src_tokens.scatter_(1, lengths + 1, eos_idx)
+    src_tokens_masks = _new_batch_tensor(lengths, len(samples), larger_size).copy_(positions < lengths + 2)
 
     id = np.array([s["id"] for s in samples])
-    src_tokens = merge("source", pad_idx=pad_idx, pading_size=larger_size)
-    src_tokens_masks = merge("text_mask", pad_idx=0, pading_size=larger_size)
 
     batch = {
         "id": id,
@@ -472,47 +478,16 @@ def collate_fn(samples, pad_idx, eos_idx):
     larger_incontext_num = max([s["patch_images"].size(0) for s in samples])
     # import pdb;pdb.set_trace()
     if samples[0].get("patch_images", None) is not None:
-        batch["net_input"]["patch_images"] = torch.stack([sample["patch_images"] for sample in samples], dim=0)
+        patch_images = [sample["patch_images"] for sample in samples]
+        out = _new_batch_tensor(patch_images[0], len(patch_images), *patch_images[0].shape)
+        batch["net_input"]["patch_images"] = torch.stack(patch_images, dim=0, out=out)
 
     return batch
 
 
-def collate_tokens(
-    values,
-    pad_idx,
-    eos_idx=None,
-    left_pad=False,
-    move_eos_to_beginning=False,
-    pad_to_length=None,
-    pad_to_multiple=1,
-    pad_to_bsz=None,
-):
-    """Convert a list of 1d tensors into a padded 2d tensor."""
-    size = max(v.size(0) for v in values)
-    size = size if pad_to_length is None else max(size, pad_to_length)
-    if pad_to_multiple != 1 and size % pad_to_multiple != 0:
-        size = int(((size - 0.1) // pad_to_multiple + 1) * pad_to_multiple)
-
-    def copy_tensor(src, dst):
-        assert dst.numel() == src.numel()
-        if move_eos_to_beginning:
-            if eos_idx is None:
-                # if no eos_idx is specified, then use the last token in src
-                dst[0] = src[-1]
-            else:
-                dst[0] = eos_idx
-            dst[1:] = src[:-1]
-        else:
-            dst.copy_(src)
-
-    if values[0].dim() == 1:
-        res = values[0].new(len(values), size).fill_(pad_idx)
-    elif values[0].dim() == 2:
-        assert move_eos_to_beginning is False
-        res = values[0].new(len(values), size, values[0].size(1)).fill_(pad_idx)
-    else:
-        raise NotImplementedError
-
-    for i, v in enumerate(values):
-        copy_tensor(v, res[i][size - len(v) :] if left_pad else res[i][: len(v)])
-    return res
+def _new_batch_tensor(like, *size):
+    """Allocate an uninitialized batch tensor like `like`, in shared memory inside a DataLoader worker."""
+    if get_worker_info() is not None:
+        storage = like._typed_storage()._new_shared(math.prod(size), device=like.device)
+        return like.new(storage).resize_(*size)
+    return like.new_empty(size)
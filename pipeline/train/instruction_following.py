@@ -71,6 +71,8 @@ def train_one_epoch(
     answer_token_id = tokenizer("<answer>", add_special_tokens=False)["input_ids"][-1]
 
     model.train()
+    # the dataset already emits bf16/fp16 patches for such vision encoders, this cast covers every other dtype
+    vision_dtype = accelerator.unwrap_model(model).vision_encoder.dtype
 
     # setup logging
     step_time_m = AverageMeter()  # time for one optimizer step (> 1 batch if using gradient accum)
@@ -90,7 +92,7 @@ def train_one_epoch(
         #### MULTI_INSTRUCT FORWARD PASS ####
         total_losses = []
         for batch_multi_instruct in batch_multi_instructs:
-            images = batch_multi_instruct["net_input"]["patch_images"]
+            images = batch_multi_instruct["net_input"]["patch_images"].to(device_id, dtype=vision_dtype, non_blocking=True)
             input_ids = batch_multi_instruct["net_input"]["input_ids"]
             attention_mask = batch_multi_instruct["net_input"]["attention_masks"]
 
@@ -278,7 +280,7 @@ def main():
     parser.add_argument(
         "--images_path",
         type=str,
-        help="path to images_path dataset, this should be a glob pattern such as vision_language_examples.tsv",
+        help="path to images_path dataset, either the images json or the .idx file written by pipeline/utils/convert_images_to_mmap.py",
     )
     parser.add_argument(
         "--train_config_path",
@@ -402,6 +404,7 @@ def main():
 
     model.lang_encoder.resize_token_embeddings(len(model.text_tokenizer))
     args.tokenizer = model.text_tokenizer
+    args.vision_dtype = model.vision_encoder.dtype
     tokenizer = model.text_tokenizer
     random_seed(args.seed, args.rank)
 
@@ -0,0 +1,37 @@
+"""Convert a MIMIC-IT images json ({image_id: base64 string}) into a flat payload file plus an index.
+
+The payload file ``<output_prefix>.bin`` holds the concatenated, already base64-decoded image files and ``<output_prefix>.idx``
+holds a pickled ``{image_id: (offset, length)}`` dict. Passing the ``.idx`` file as ``--images_path`` lets
+MimicitDataset memory-map the payloads, so all DataLoader workers share the same page cache instead of each
+holding a private copy of the images dict, and skips the base64 decode on every sample.
+"""
+
+import argparse
+import pickle
+
+import ijson
+import pybase64
+from tqdm import tqdm
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("--images_path", type=str, help="path to the MIMIC-IT images json")
+arg_parser.add_argument("--output_prefix", type=str, help="writes <output_prefix>.bin and <output_prefix>.idx")
+args = arg_parser.parse_args()
+
+
+def main():
+    index = {}
+    offset = 0
+    with open(args.images_path, "rb") as f_in, open(f"{args.output_prefix}.bin", "wb") as f_out:
+        for image_id, image in tqdm(ijson.kvitems(f_in, "")):
+            payload = pybase64.urlsafe_b64decode(image)
+            f_out.write(payload)
+            index[image_id] = (offset, len(payload))
+            offset += len(payload)
+
+    with open(f"{args.output_prefix}.idx", "wb") as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+if __name__ == "__main__":
+    main()